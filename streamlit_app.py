@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import hashlib
+import io
 import os
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from functools import reduce
-from st_aggrid import AgGrid, GridOptionsBuilder
+from importlib.util import find_spec
 
 # ==================================================
 # PAGE CONFIG - MUST BE FIRST
@@ -33,20 +42,110 @@ if selected_page != st.session_state["current_page"]:
 # ==================================================
 # HELPER FUNCTIONS
 # ==================================================
-def load_file(uploaded_file):
+# CSV uploads above this size are converted to pandas column by column to cap peak memory
+LARGE_CSV_BYTES = 50 << 20
+
+# pd.read_csv's default missing-value and boolean tokens, so Arrow reads cells as pandas did
+CSV_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null",
+]
+CSV_TRUE_VALUES = ["True", "TRUE", "true"]
+CSV_FALSE_VALUES = ["False", "FALSE", "false"]
+
+# Rows per Parquet row group of the stored master document; a page of the Master Document
+# (a divisor of this) is decoded from a single group instead of the whole file
+MASTER_ROW_GROUP_ROWS = 10_000
+
+# Up to 5 distinct colors for the columns, one per uploaded file
+COLOR_PALETTE = ["#FFCFCF", "#CFFFCF", "#CFCFFF", "#FFFACF", "#FFCFFF"]
+
+# Excel is read with the Rust-based calamine parser when pandas (>= 2.2) and
+# python-calamine support it; otherwise pandas picks openpyxl/xlrd as before
+_PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split(".")[:2])
+EXCEL_ENGINE = "calamine" if _PANDAS_VERSION >= (2, 2) and find_spec("python_calamine") else None
+
+def _matches_pandas_inference(table):
     """
-    Reads an uploaded file (CSV, XLSX, or XLS) into a DataFrame,
-    dropping completely empty columns.
+    Tells whether Arrow read a CSV into the columns pd.read_csv would give. It differs when
+    the header repeats or leaves out a name (pandas writes 'x.1', 'Unnamed: 0'), for dates
+    and times (pandas keeps their text), for bytes that are not UTF-8 (pandas raises), and
+    for integers beyond int64 (Arrow rounds them to float64, pandas keeps them exact).
     """
-    _, extension = os.path.splitext(uploaded_file.name.lower())
+    names = table.column_names
+    if len(set(names)) != len(names) or "" in names:
+        return False
+    for column in table.columns:
+        if pa.types.is_temporal(column.type) or pa.types.is_binary(column.type):
+            return False
+        # Only float columns this large can hold integers that overflowed int64
+        if pa.types.is_floating(column.type) and (pc.max(pc.abs(column)).as_py() or 0) >= 2 ** 63:
+            return False
+    return True
+
+def _read_csv(data):
+    """
+    Reads CSV bytes with Arrow's multi-threaded reader, falling back to pandas' C parser
+    for files Arrow rejects while parsing or converting (e.g. rows with missing trailing
+    fields) or reads differently from pandas (see _matches_pandas_inference). Columns that
+    are entirely empty are dropped.
+    """
+    try:
+        # Empty/NA tokens become nulls in string columns too, as with pd.read_csv
+        table = pacsv.read_csv(
+            io.BytesIO(data),
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 20),
+            convert_options=pacsv.ConvertOptions(
+                null_values=CSV_NA_VALUES,
+                true_values=CSV_TRUE_VALUES,
+                false_values=CSV_FALSE_VALUES,
+                strings_can_be_null=True,
+            ),
+        )
+        if _matches_pandas_inference(table):
+            # Arrow tracks null counts per column, so empty columns are found without scanning values
+            table = table.select(
+                [i for i, column in enumerate(table.columns) if column.null_count < table.num_rows]
+            )
+            if len(data) > LARGE_CSV_BYTES:
+                # Free each Arrow column once converted so both full copies never coexist
+                df = table.to_pandas(split_blocks=True, self_destruct=True)
+                del table
+                return df
+            return table.to_pandas()
+    except (ValueError, pa.ArrowException):  # rejected while parsing or converting to pandas
+        pass
+    return pd.read_csv(io.BytesIO(data)).dropna(axis=1, how="all")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _parse_bytes(name: str, data: bytes) -> pd.DataFrame:
+    """
+    Parses the raw bytes of an uploaded file (CSV, XLSX, or XLS) into a DataFrame,
+    dropping completely empty columns. Cached on (name, bytes) so reruns skip parsing.
+    """
+    _, extension = os.path.splitext(name.lower())
     if extension == ".csv":
-        df = pd.read_csv(uploaded_file)
+        df = _read_csv(data)
     elif extension in [".xlsx", ".xls"]:
-        df = pd.read_excel(uploaded_file)
+        # Drop columns that are entirely empty
+        df = pd.read_excel(io.BytesIO(data), engine=EXCEL_ENGINE).dropna(axis=1, how="all")
     else:
         raise ValueError(f"Unsupported file type: {extension}")
-    # Drop columns that are entirely empty
-    df = df.loc[:, df.notna().any()]
+    return shrink_dtypes(df)
+
+def shrink_dtypes(df):
+    """
+    Downcasts integer columns to the smallest lossless width and stores low-cardinality
+    string columns as categoricals. The 'ID' key column is left untouched.
+    """
+    for col in df.columns.drop("ID", errors="ignore"):
+        series = df[col]
+        if pd.api.types.is_integer_dtype(series):
+            df[col] = pd.to_numeric(series, downcast="integer")
+        elif (series.dtype == object
+              and pd.api.types.infer_dtype(series, skipna=True) == "string"
+              and series.nunique() < len(series) // 2):
+            df[col] = series.astype("category")
     return df
 
 def check_expected_key(df, file_name):
@@ -60,15 +159,206 @@ def rename_non_key_columns(df, file_name):
     Renames each column except 'ID' to include the file name as a suffix.
     e.g. 'A' -> 'A__{file_name}'
     """
-    new_cols = {}
-    for col in df.columns:
-        if col != "ID":
-            new_cols[col] = f"{col}__{file_name}"
-    return df.rename(columns=new_cols)
+    cols = df.columns
+    return df.set_axis(cols.where(cols == "ID", cols.astype(str) + f"__{file_name}"), axis=1, copy=False)
 
 def get_file_columns(df):
-    """Return the list of columns (excluding 'ID') that belong to this file."""
-    return [col for col in df.columns if col != "ID"]
+    """Return the columns (excluding 'ID') that belong to this file, as an Index."""
+    return df.columns.drop("ID")
+
+def sort_by_id(df):
+    """Orders rows by 'ID' (missing IDs last), skipping the sort when they are already in order."""
+    if not df["ID"].is_monotonic_increasing:
+        df = df.sort_values(by="ID", kind="stable")
+    return df.reset_index(drop=True)
+
+def merge_on_id(df_list):
+    """
+    Outer-joins the per-file DataFrames on 'ID' with a single aligned concat,
+    rather than folding pairwise merges that rebuild the growing frame each step.
+    A single file needs no join. Files where an 'ID' repeats, whose 'ID' dtypes differ, or
+    whose columns collide (the same file name uploaded twice) fall back to pairwise merges,
+    which keep pd.merge's errors and '_x'/'_y' suffixes for those cases.
+    """
+    if len(df_list) == 1:
+        return sort_by_id(df_list[0])
+    data_cols = [col for df in df_list for col in df.columns.drop("ID")]
+    if (any(df["ID"].duplicated().any() for df in df_list)
+            or len({df["ID"].dtype for df in df_list}) > 1
+            or len(set(data_cols)) != len(data_cols)):
+        return sort_by_id(reduce(lambda left, right: pd.merge(left, right, on="ID", how="outer"), df_list))
+    # Pre-sorted indexes let the sorted union run as a linear merge; sort_by_id then only
+    # re-sorts when a missing ID was placed first, so it still ends up last
+    indexed = [df.set_index("ID").sort_index() for df in df_list]
+    return sort_by_id(pd.concat(indexed, axis=1, copy=False, sort=True).reset_index())
+
+def _arrow_safe(df):
+    """Casts mixed-type object columns (common in Excel sheets) to strings so Arrow can store them."""
+    mixed = [
+        col for col in df.select_dtypes(include="object").columns
+        if pd.api.types.infer_dtype(df[col], skipna=True) in ("mixed", "mixed-integer")
+    ]
+    if not mixed:
+        return df
+    df = df.copy()
+    for col in mixed:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def to_parquet_bytes(df):
+    """
+    Serializes a DataFrame to ZSTD-compressed Parquet bytes. The merged data is stored
+    in this form instead of as a live DataFrame, which shrinks per-session memory considerably.
+    """
+    buf = io.BytesIO()
+    _arrow_safe(df).to_parquet(
+        buf, engine="pyarrow", compression="zstd", index=False, row_group_size=MASTER_ROW_GROUP_ROWS
+    )
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_master(files):
+    """
+    Parses, validates and merges the uploaded files, given as a tuple of (name, bytes) pairs.
+    Returns the merged data as Parquet bytes, each file's renamed columns, and the numeric
+    columns. Cached on the file contents, so re-processing an identical upload set skips
+    the whole pipeline.
+    """
+    # Parse files concurrently; Arrow/pandas parsing releases the GIL
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        parsed = list(executor.map(lambda f: _parse_bytes(*f), files))
+
+    df_list = []
+    file_columns = {}
+    for (name, _), df in zip(files, parsed):
+        check_expected_key(df, name)
+        df = rename_non_key_columns(df, name)
+        file_columns[name] = get_file_columns(df)
+        df_list.append(df)
+
+    # Merge on 'ID' using outer join
+    master_df = merge_on_id(df_list)
+    numeric_cols = master_df.select_dtypes(include="number").columns.tolist()
+    return to_parquet_bytes(master_df), file_columns, numeric_cols
+
+def _remove_file(path):
+    """Deletes a file, ignoring it if it is already gone."""
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+def _session_dir():
+    """
+    Returns this session's temporary directory. It lives in session state, so it is removed
+    with its contents once the session ends and its state is released, or at server exit.
+    """
+    if "master_dir" not in st.session_state:
+        st.session_state["master_dir"] = tempfile.TemporaryDirectory(prefix="drug_blender_")
+    return st.session_state["master_dir"].name
+
+def store_master(master_pq):
+    """
+    Writes the merged Parquet bytes to a file in this session's temporary directory and keeps
+    only its path in session state, deleting the file from any previous ingestion in this session.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".parquet", dir=_session_dir()) as tmp:
+        tmp.write(master_pq)
+    previous = st.session_state.get("master_path")
+    st.session_state["master_path"] = tmp.name
+    if previous:
+        _remove_file(previous)
+
+def master_layout():
+    """Returns the row count and column names of the stored master document, read from its Parquet footer."""
+    parquet_file = pq.ParquetFile(st.session_state["master_path"])
+    return parquet_file.metadata.num_rows, parquet_file.schema_arrow.names
+
+def load_master_rows(start, stop):
+    """
+    Re-materializes rows [start, stop) of the merged DataFrame from its Parquet file,
+    decoding only the row groups that hold them.
+    """
+    parquet_file = pq.ParquetFile(st.session_state["master_path"])
+    groups, first_row, offset = [], 0, 0
+    for i in range(parquet_file.num_row_groups):
+        num_rows = parquet_file.metadata.row_group(i).num_rows
+        if offset < stop and offset + num_rows > start:
+            if not groups:
+                first_row = offset
+            groups.append(i)
+        offset += num_rows
+    if not groups:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    df = parquet_file.read_row_groups(groups).to_pandas()
+    df.index = pd.RangeIndex(first_row, first_row + len(df))
+    return df.iloc[max(start - first_row, 0):stop - first_row]
+
+def summarize_numeric(df):
+    """
+    Returns the same table as df.describe() for numeric columns, computed with frame-wide
+    reductions (one vectorized pass per statistic) instead of describing each column in turn.
+    """
+    stats = pd.DataFrame({"count": df.count(), "mean": df.mean(), "std": df.std(), "min": df.min()}).T
+    quartiles = df.quantile([0.25, 0.5, 0.75])
+    quartiles.index = ["25%", "50%", "75%"]
+    return pd.concat([stats, quartiles, df.max().to_frame("max").T])
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def numeric_summary(master_path, numeric_cols):
+    """Summarizes the given numeric columns of a stored master document, reading only those columns."""
+    return summarize_numeric(pd.read_parquet(master_path, columns=list(numeric_cols)))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def count_missing(master_path):
+    """
+    Counts missing values per column of a stored master document from the null counts
+    in its Parquet footer, so no column data has to be read or decoded.
+    """
+    metadata = pq.read_metadata(master_path)
+    names = metadata.schema.to_arrow_schema().names
+    counts = [0] * len(names)
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            stats = row_group.column(j).statistics
+            if stats is None or not stats.has_null_count:
+                # No footer statistics; count from the data instead
+                return pd.read_parquet(master_path).isna().sum()
+            counts[j] += stats.null_count
+    return pd.Series(counts, index=names, dtype="int64")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def master_csv(master_path):
+    """Encodes a stored master document as CSV bytes, once per stored file rather than per rerun."""
+    return pd.read_parquet(master_path).to_csv(index=False).encode("utf-8")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_grid_styling(columns, file_columns, colors):
+    """
+    Builds the AgGrid column definitions and the per-file CSS rules for the master document.
+    Takes tuples (columns, (file, columns) pairs, (file, color) pairs) so the result is
+    cached across reruns and only rebuilt when a new upload changes them.
+    """
+    # One CSS rule per file instead of an inline style object on every column
+    file_classes = {fname: f"file-{i}" for i, (fname, _) in enumerate(colors)}
+    file_css = {
+        f".{file_classes[fname]}": {
+            "background-color": f"{color} !important",
+            "color": "#000000"  # ensure text is visible
+        }
+        for fname, color in colors
+    }
+    col_classes = {col: file_classes[fname] for fname, cols in file_columns for col in cols}
+
+    col_defs = []
+    for col in columns:
+        col_def = {"field": col}
+        if col == "ID":
+            # Optionally pin ID to the left
+            col_def["pinned"] = "left"
+        elif col in col_classes:
+            col_def["cellClass"] = col_classes[col]
+        col_defs.append(col_def)
+    return col_defs, file_css
 
 # ==================================================
 # PAGE 1: DATA INGESTION
@@ -97,35 +387,32 @@ def data_ingestion_page():
             # Unique key for the "Process Files" button
             if st.button("Process Files", key="process_files_ingestion"):
                 try:
-                    df_list = []
-                    file_columns = {}
-                    color_map = {}
-                    # Up to 5 distinct colors for the columns
-                    color_palette = ["#FFCFCF", "#CFFFCF", "#CFCFFF", "#FFFACF", "#FFCFFF"]
-
-                    for i, file in enumerate(uploaded_files):
-                        df = load_file(file)
-                        check_expected_key(df, file.name)
-                        df = rename_non_key_columns(df, file.name)
-                        file_columns[file.name] = get_file_columns(df)
-                        df_list.append(df)
-                        color_map[file.name] = color_palette[i]
-                    
-                    # Merge on 'ID' using outer join
-                    from functools import reduce
-                    master_df = reduce(lambda left, right: pd.merge(left, right, on="ID", how="outer"), df_list)
-                    master_df = master_df.sort_values(by="ID").reset_index(drop=True)
-
-                    # Store in session state
-                    st.session_state["master_df"] = master_df
-                    st.session_state["file_columns"] = file_columns
-                    st.session_state["color_map"] = color_map
-
+                    files = tuple((file.name, file.getvalue()) for file in uploaded_files)
+                    # Fingerprint on names and contents; reuse the stored results for an identical upload set
+                    upload_sig = tuple((name, hashlib.sha1(data).hexdigest()) for name, data in files)
+                    if (st.session_state.get("upload_sig") != upload_sig
+                            or "master_path" not in st.session_state):
+                        color_map = dict(zip((name for name, _ in files), COLOR_PALETTE))
+                        master_pq, file_columns, numeric_cols = build_master(files)
+
+                        # Store in session state
+                        store_master(master_pq)
+                        st.session_state["file_columns"] = file_columns
+                        st.session_state["color_map"] = color_map
+                        st.session_state["numeric_cols"] = numeric_cols
+                        st.session_state["upload_sig"] = upload_sig
+                        # Bumped per new master so the grid remounts only when its data changes
+                        st.session_state["master_version"] = st.session_state.get("master_version", 0) + 1
+                        # New data starts the Master Document back on its first page
+                        st.session_state.pop("master_page", None)
+
+                    # Shape and columns come from the Parquet footer; only the preview rows are decoded
+                    n_rows, columns = master_layout()
                     st.success("Files uploaded and merged successfully!")
                     st.write("**Preview of Merged Data (first 15 rows):**")
-                    st.dataframe(master_df.head(15))
-                    st.write(f"**Final Shape:** {master_df.shape} (rows, columns)")
-                    st.write("**Columns:**", list(master_df.columns))
+                    st.dataframe(load_master_rows(0, 15))
+                    st.write(f"**Final Shape:** {(n_rows, len(columns))} (rows, columns)")
+                    st.write("**Columns:**", list(columns))
                 except Exception as e:
                     st.error(f"Error processing files: {e}")
     else:
@@ -134,68 +421,76 @@ def data_ingestion_page():
 # ==================================================
 # PAGE 2: MASTER DOCUMENT
 # ==================================================
+# Rows sent to the grid per page, so each rerun ships a bounded payload
+MASTER_PAGE_SIZE = 500
+
 def master_document_page():
     st.header("Master Document")
     st.write("Below is the merged dataset with one row per ID. All data from each file appear side‑by‑side, "
              "with each file’s columns color-coded. You can drag and reorder columns interactively.")
 
-    if ("master_df" in st.session_state and 
+    if ("master_path" in st.session_state and 
         "file_columns" in st.session_state and 
         "color_map" in st.session_state):
 
-        master_df = st.session_state["master_df"]
+        n_rows, columns = master_layout()
         file_columns = st.session_state["file_columns"]
         color_map = st.session_state["color_map"]
 
-        # Legend
+        # Legend, sent to the frontend as a single markdown element
         st.markdown("### Legend (File → Color):")
-        for fname, color in color_map.items():
-            st.markdown(
-                f'<div style="display:inline-block;width:20px;height:20px;'
-                f'background-color:{color};margin-right:10px;"></div>{fname}',
-                unsafe_allow_html=True
+        legend_html = "<br>".join(
+            f'<div style="display:inline-block;width:20px;height:20px;'
+            f'background-color:{color};margin-right:10px;"></div>{fname}'
+            for fname, color in color_map.items()
+        )
+        st.markdown(legend_html, unsafe_allow_html=True)
+
+        # Paginate large documents so only one slice is read from disk and serialized to the grid
+        page = 1
+        if n_rows > MASTER_PAGE_SIZE:
+            n_pages = (n_rows - 1) // MASTER_PAGE_SIZE + 1
+            page = st.number_input(
+                f"Page (1–{n_pages})", min_value=1, max_value=n_pages, value=1, step=1,
+                key="master_page"
             )
-
-        # Build column definitions for AgGrid with color-coded cellStyle
-        from st_aggrid import AgGrid, GridOptionsBuilder
-
-        col_defs = []
-        for col in master_df.columns:
-            col_def = {"field": col}
-            if col == "ID":
-                # Optionally pin ID to the left
-                col_def["pinned"] = "left"
-            else:
-                # Determine which file contributed this column
-                for fname, cols in file_columns.items():
-                    if col in cols:
-                        col_def["cellStyle"] = {
-                            "backgroundColor": color_map[fname],  # JS-style camelCase
-                            "color": "#000000"                    # ensure text is visible
-                        }
-                        break
-            col_defs.append(col_def)
+        start = (page - 1) * MASTER_PAGE_SIZE
+        page_df = load_master_rows(start, start + MASTER_PAGE_SIZE)
+        if n_rows > MASTER_PAGE_SIZE:
+            st.caption(f"Showing rows {start + 1}–{start + len(page_df)} of {n_rows}")
+
+        # Build column definitions for AgGrid with a color-coded cellClass per file
+        from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
+
+        col_defs, file_css = build_grid_styling(
+            tuple(columns),
+            tuple((fname, tuple(cols)) for fname, cols in file_columns.items()),
+            tuple(color_map.items())
+        )
 
         # Build AgGrid options
-        gb = GridOptionsBuilder.from_dataframe(master_df)
+        gb = GridOptionsBuilder.from_dataframe(page_df)
         gb.configure_grid_options(enableColReorder=True)
         gridOptions = gb.build()
         gridOptions["columnDefs"] = col_defs
 
-        # Display the AgGrid
+        # Display the AgGrid; the key changes only with the data, so other reruns keep the mounted grid
         AgGrid(
-            master_df,
+            page_df,
             gridOptions=gridOptions,
             height=500,
             width='100%',
-            reload_data=True,
+            reload_data=False,
+            update_mode=GridUpdateMode.NO_UPDATE,
+            key=f"master_grid_{st.session_state.get('master_version', 0)}_{page}",
             enable_enterprise_modules=False,
-            allow_unsafe_jscode=True,
-            theme='streamlit'
+            allow_unsafe_jscode=False,
+            theme='streamlit',
+            custom_css=file_css
         )
 
         # Download button for merged data
-        csv_data = master_df.to_csv(index=False)
+        csv_data = master_csv(st.session_state["master_path"])
         st.download_button(
             label="Download Merged Data as CSV",
             data=csv_data,
@@ -213,25 +508,28 @@ def analysis_page():
     st.header("Analysis & Insights")
     st.write("This page provides a high-level analysis of the merged data.")
 
-    if "master_df" in st.session_state:
-        master_df = st.session_state["master_df"]
+    if "master_path" in st.session_state and "numeric_cols" in st.session_state:
+        master_path = st.session_state["master_path"]
 
-        numeric_cols = master_df.select_dtypes(include=["int", "float"]).columns
+        numeric_cols = st.session_state["numeric_cols"]
         if len(numeric_cols) > 0:
             st.subheader("Numeric Column Summaries")
-            st.write(master_df[numeric_cols].describe())
+            if st.checkbox("Show numeric summary", value=False, key="show_numeric_summary"):
+                st.write(numeric_summary(master_path, tuple(numeric_cols)))
         else:
             st.info("No numeric columns found to summarize.")
 
-        missing_counts = master_df.isna().sum()
+        missing_counts = count_missing(master_path)
         if missing_counts.sum() > 0:
             st.subheader("Missing Data Overview")
             st.write(missing_counts[missing_counts > 0])
         else:
             st.write("No missing data found.")
 
-        total_rows = len(master_df)
-        total_cols = len(master_df.columns)
+        # Shape comes from the Parquet footer, so the Analysis page never loads the full frame
+        metadata = pq.read_metadata(master_path)
+        total_rows = metadata.num_rows
+        total_cols = metadata.num_columns
         st.write(f"**Total Rows:** {total_rows}")
         st.write(f"**Total Columns:** {total_cols}")
 